@@ -1,9 +1,12 @@
+import datetime
+import math
 import os
 import re
+from functools import lru_cache
+import numpy as np
 import pandas as pd
-from rapidfuzz import fuzz
-from openpyxl import load_workbook
-from openpyxl.styles import PatternFill
+from rapidfuzz import fuzz, process
+import xlsxwriter
 import gradio as gr
 import gradio.themes as gthemes
 
@@ -11,14 +14,14 @@ import gradio.themes as gthemes
 # 🧩 Setup – Normalization helpers and constants
 # ============================================================
 
-SUFFIXES = {
+SUFFIXES = frozenset({
     "ltd", "limited", "co", "company", "corp", "corporation", "inc", "incorporated",
     "plc", "public", "llc", "lp", "llp", "ulc", "pc", "pllc", "sa", "ag", "nv",
     "se", "bv", "oy", "ab", "aps", "as", "kft", "zrt", "rt", "sarl", "sas", "spa",
     "gmbh", "ug", "bvba", "cvba", "nvsa", "pte", "pty", "bhd", "sdn", "kabushiki",
     "kaisha", "kk", "godō", "dmcc", "pjsc", "psc", "jsc", "ltda", "srl", "s.r.l",
     "group", "holdings", "limitedpartnership"
-}
+})
 
 COUNTRY_EQUIVALENTS = {
     "uk": "united kingdom", "u.k.": "united kingdom", "england": "united kingdom",
@@ -38,75 +41,215 @@ COUNTRY_EQUIVALENTS = {
 # 🧹 Text cleaning helpers
 # ============================================================
 
+_NONALNUM_RE = re.compile(r"[^a-zA-Z0-9\s]")
+_SUFFIX_RE = re.compile(r"\b(?:" + "|".join(map(re.escape, sorted(SUFFIXES, key=len, reverse=True))) + r")\b")
+_WS_RE = re.compile(r"\s+")
+_HOST_RE = re.compile(r"^(?:https?://)?(?:www\.)?([^/]*)")
+_WWW_RE = re.compile(r"^www\.")
+_PATH_RE = re.compile(r"/.*$")
+
+@lru_cache(maxsize=100_000)
 def _normalize_tokens(text: str) -> str:
     if not isinstance(text, str):
         return ""
-    text = re.sub(r"[^a-zA-Z0-9\s]", " ", text.lower())
-    parts = [w for w in text.split() if w not in SUFFIXES]
-    return " ".join(parts).strip()
+    text = _NONALNUM_RE.sub(" ", text.lower())
+    text = _SUFFIX_RE.sub(" ", text)
+    return _WS_RE.sub(" ", text).strip()
 
+@lru_cache(maxsize=100_000)
 def _clean_domain(domain: str) -> str:
     if not isinstance(domain, str):
         return ""
-    domain = domain.lower()
-    domain = re.sub(r"^https?://", "", domain)
-    domain = re.sub(r"/.*$", "", domain)
-    domain = re.sub(r"^www\.", "", domain)
-    parts = domain.split(".")
+    domain = _HOST_RE.match(domain.lower()).group(1)
+    parts = domain.rsplit(".", 2)
     return parts[-2] if len(parts) >= 2 else domain
 
-def _extract_domain_from_email(email: str) -> str:
-    if not isinstance(email, str) or "@" not in email:
-        return ""
-    domain = email.split("@")[-1].lower().strip()
-    domain = re.sub(r"^www\.", "", domain)
-    domain = re.sub(r"/.*$", "", domain)
-    return domain
+def _extract_domains_from_emails(emails: pd.Series) -> pd.Series:
+    # Non-string cells cannot contain "@" once stringified, so they fall through to "".
+    emails = emails.astype(str)
+    domains = emails.str.split("@").str[-1].str.lower().str.strip()
+    domains = domains.str.replace(_WWW_RE, "", regex=True).str.replace(_PATH_RE, "", regex=True)
+    return domains.where(emails.str.contains("@", regex=False), "")
+
+def _normalize_country_series(values: pd.Series) -> np.ndarray:
+    # Country columns are low-cardinality: normalize each category once, then expand by code.
+    vals = values.astype(str).astype("category")
+    labels = vals.cat.categories
+    canonical = labels.str.strip().str.lower().map(COUNTRY_EQUIVALENTS)
+    return np.where(canonical.notna(), canonical, labels)[vals.cat.codes.to_numpy()]
 
 # ============================================================
 # 🌐 Company ↔ Domain Comparison
 # ============================================================
 
-def compare_company_domain(company: str, domain: str):
-    if not isinstance(company, str) or not isinstance(domain, str):
+DOMAIN_ALIASES = {
+    "johnlewis": "john lewis group",
+    "directlinegroup": "direct line group",
+    "dlg": "direct line group",
+    "matalan": "matalan",
+    "ticketmaster": "ticketmaster",
+    "deliveroo": "deliveroo",
+    "motorway": "motorway",
+    "monsoon": "monsoon accessorize",
+    "uktv": "uktv",
+    "mg": "mg motor",
+    "thg": "the hut group",
+    "ihg": "intercontinental hotels group",
+    "imperialbrands": "imperial brands"
+}
+
+STRONG_FUZZY = 85
+WEAK_FUZZY = 70
+
+# Indexed by fuzzy band: 0 = strong, 1 = weak, 2 = low.
+_FUZZY_STATUSES = np.array(["Likely Match", "Unsure – Please Check", "Likely NOT Match"], dtype=object)
+_FUZZY_REASONS = np.array(["strong fuzzy", "weak fuzzy", "low similarity"], dtype=object)
+
+def _domain_key(domain: str) -> str:
+    d = _clean_domain(domain.lower().strip())
+    return DOMAIN_ALIASES.get(d, d)
+
+def _rule_verdict(c: str, d: str, c_ns: str, d_ns: str):
+    # No usable domain (blank/malformed email): "" would otherwise be "contained" in every name.
+    if not d:
         return "Unsure – Please Check", 0, "missing input"
 
-    c = _normalize_tokens(company)
-    d_raw = domain.lower().strip()
-    d = _clean_domain(d_raw)
-
-    aliases = {
-        "johnlewis": "john lewis group",
-        "directlinegroup": "direct line group",
-        "dlg": "direct line group",
-        "matalan": "matalan",
-        "ticketmaster": "ticketmaster",
-        "deliveroo": "deliveroo",
-        "motorway": "motorway",
-        "monsoon": "monsoon accessorize",
-        "uktv": "uktv",
-        "mg": "mg motor",
-        "thg": "the hut group",
-        "ihg": "intercontinental hotels group",
-        "imperialbrands": "imperial brands"
-    }
-
-    if d in aliases:
-        d = aliases[d]
-
-    if d.replace(" ", "") in c.replace(" ", "") or c.replace(" ", "") in d.replace(" ", ""):
+    if d_ns in c_ns or c_ns in d_ns:
         return "Likely Match", 100, "direct containment"
 
     if len(d) <= 3 and d in c:
         return "Likely Match", 95, f"short alias match ({d})"
 
-    score = fuzz.token_set_ratio(c, d)
-    if score >= 85:
-        return "Likely Match", score, "strong fuzzy"
-    elif score >= 70:
-        return "Unsure – Please Check", score, "weak fuzzy"
-    else:
-        return "Likely NOT Match", score, "low similarity"
+    return None
+
+def _fuzzy_band(score):
+    return 2 - (score >= STRONG_FUZZY).astype(np.int8) - (score >= WEAK_FUZZY).astype(np.int8)
+
+def _fuzzy_verdict(score):
+    band = _fuzzy_band(np.float64(score))
+    return _FUZZY_STATUSES[band], score, _FUZZY_REASONS[band]
+
+def compare_company_domain(company: str, domain: str):
+    if not isinstance(company, str) or not isinstance(domain, str):
+        return "Unsure – Please Check", 0, "missing input"
+
+    c = _normalize_tokens(company)
+    d = _domain_key(domain)
+    return _rule_verdict(c, d, c.replace(" ", ""), d.replace(" ", "")) or _fuzzy_verdict(fuzz.token_set_ratio(c, d, processor=None))
+
+def _map_unique(values: pd.Series, fn) -> np.ndarray:
+    # Company names and domains repeat across contacts; clean each distinct value once.
+    uniques = values.drop_duplicates()
+    return values.map(dict(zip(uniques, uniques.map(fn)))).to_numpy(dtype=object)
+
+def _score_company_domain(companies: pd.Series, domains: pd.Series):
+    comp_arr = _map_unique(companies, _normalize_tokens)
+    dom_arr = _map_unique(domains, lambda x: _domain_key(x) if isinstance(x, str) else "")
+    comp_ns = pd.Series(comp_arr).str.replace(" ", "", regex=False).to_numpy(dtype=object)
+    dom_ns = pd.Series(dom_arr).str.replace(" ", "", regex=False).to_numpy(dtype=object)
+
+    n = len(comp_arr)
+    statuses = np.empty(n, dtype=object)
+    scores = np.empty(n, dtype=object)
+    reasons = np.empty(n, dtype=object)
+    pending = np.zeros(n, dtype=bool)
+
+    rows = zip(companies.to_numpy(dtype=object), domains.to_numpy(dtype=object), comp_arr, dom_arr, comp_ns, dom_ns)
+    for i, (company, domain, c, d, c_ns, d_ns) in enumerate(rows):
+        if not isinstance(company, str) or not isinstance(domain, str):
+            statuses[i], scores[i], reasons[i] = "Unsure – Please Check", 0, "missing input"
+            continue
+        verdict = _rule_verdict(c, d, c_ns, d_ns)
+        if verdict:
+            statuses[i], scores[i], reasons[i] = verdict
+        else:
+            pending[i] = True
+
+    if not pending.any():
+        # MultiIndex.factorize cannot build an empty result.
+        return statuses, scores, reasons
+
+    # Only rows the containment/alias rules could not settle need a fuzzy score, and
+    # spelling variants ("Acme Ltd" / "Acme Limited") collapse to one normalized pair.
+    pair_id, uniq = pd.MultiIndex.from_arrays([comp_arr[pending], dom_arr[pending]]).factorize()
+    fuzzy = process.cpdist(uniq.get_level_values(0).to_numpy(), uniq.get_level_values(1).to_numpy(),
+                           scorer=fuzz.token_set_ratio, processor=None, workers=-1, dtype=np.float64)[pair_id]
+    band = _fuzzy_band(fuzzy)
+    statuses[pending] = _FUZZY_STATUSES[band]
+    reasons[pending] = _FUZZY_REASONS[band]
+    scores[pending] = fuzzy.astype(object)
+
+    return statuses, scores, reasons
+
+def compare_company_domain_series(companies: pd.Series, domains: pd.Series):
+    """Column-wise compare_company_domain: score each distinct (company, domain) pair once, in one batch."""
+    pairs = pd.DataFrame({"company": companies.to_numpy(dtype=object), "domain": domains.to_numpy(dtype=object)})
+    uniq = pairs.drop_duplicates().reset_index(drop=True)
+    uniq["status"], uniq["score"], uniq["reason"] = _score_company_domain(uniq["company"], uniq["domain"])
+
+    out = pairs.merge(uniq, on=["company", "domain"], how="left")
+    return out["status"].to_numpy(), out["score"].to_numpy(), out["reason"].to_numpy()
+
+# ============================================================
+# 📥 Excel input
+# ============================================================
+
+def _read_excel(path: str) -> pd.DataFrame:
+    # calamine (Rust) parses xlsx several times faster than openpyxl; pandas'
+    # openpyxl reader is already read_only/data_only, so it is the fallback.
+    try:
+        return pd.read_excel(path, engine="calamine")
+    except ImportError:
+        return pd.read_excel(path, engine="openpyxl")
+
+# ============================================================
+# 💾 Excel output
+# ============================================================
+
+def _cell_value(v):
+    # Mirror to_excel: blank for NaN/NaT/None, inf as text (inf_rep; write_number rejects
+    # non-finite floats), times as text and durations as day fractions.
+    if v is None or v is pd.NaT or v is pd.NA:
+        return None
+    if isinstance(v, datetime.time):
+        return str(v)
+    if isinstance(v, datetime.timedelta):
+        return v.total_seconds() / 86400
+    if isinstance(v, float):
+        if math.isnan(v):
+            return None
+        if math.isinf(v):
+            return "inf" if v > 0 else "-inf"
+    return v
+
+def _write_results(df_out: pd.DataFrame, out_file: str):
+    """Stream df_out row by row; status colours are conditional formats, not per-cell fills."""
+    wb = xlsxwriter.Workbook(out_file, {
+        "constant_memory": True,
+        "strings_to_urls": False,
+        "default_date_format": "YYYY-MM-DD HH:MM:SS",
+    })
+    ws = wb.add_worksheet("Sheet1")
+    header = wb.add_format({"bold": True, "border": 1, "align": "center", "valign": "top"})
+    yellow = wb.add_format({"bg_color": "#FFFF00"})
+    green = wb.add_format({"bg_color": "#C6EFCE"})
+    red = wb.add_format({"bg_color": "#FFC7CE"})
+
+    ws.write_row(0, 0, [str(c) for c in df_out.columns], header)
+    for r, row in enumerate(df_out.itertuples(index=False, name=None), start=1):
+        ws.write_row(r, 0, [_cell_value(v) for v in row])
+
+    n_rows = len(df_out)
+    for col_idx, col in enumerate(df_out.columns):
+        if "Domain_Check_Status" in col and n_rows:
+            rng = (1, col_idx, n_rows, col_idx)
+            ws.conditional_format(*rng, {"type": "text", "criteria": "containing", "value": "likely match",
+                                         "format": green, "stop_if_true": True})
+            ws.conditional_format(*rng, {"type": "text", "criteria": "containing", "value": "not match",
+                                         "format": red, "stop_if_true": True})
+            ws.conditional_format(*rng, {"type": "formula", "criteria": "TRUE", "format": yellow})
+
+    wb.close()
 
 # ============================================================
 # 🧮 Main Matching Function
@@ -115,15 +258,15 @@ def compare_company_domain(company: str, domain: str):
 def run_matching(master_file, picklist_file, highlight_changes=True, progress=gr.Progress(track_tqdm=True)):
     try:
         progress(0, desc="📂 Reading uploaded files...")
-        df_master = pd.read_excel(master_file.name)
-        df_picklist = pd.read_excel(picklist_file.name)
+        df_master = _read_excel(master_file.name)
+        df_picklist = _read_excel(picklist_file.name)
 
         progress(0.2, desc="🔧 Preparing data...")
-        df_out = df_master.copy()
+        df_out = df_master.copy(deep=False)  # only whole-column assignments below
 
         for col in df_master.columns:
             if "country" in col.lower():
-                df_out[col] = df_master[col].astype(str).apply(lambda x: COUNTRY_EQUIVALENTS.get(x.strip().lower(), x))
+                df_out[col] = _normalize_country_series(df_master[col])
 
         progress(0.6, desc="🌐 Validating company ↔ email domain...")
         company_cols = [c for c in df_master.columns if c.strip().lower() in ["company", "companyname", "company name"]]
@@ -133,14 +276,8 @@ def run_matching(master_file, picklist_file, highlight_changes=True, progress=gr
             company_col = company_cols[0]
             email_col = email_cols[0]
 
-            statuses, scores, reasons = [], [], []
-            for i in range(len(df_master)):
-                comp = df_master.at[i, company_col]
-                dom = _extract_domain_from_email(df_master.at[i, email_col]) if pd.notna(df_master.at[i, email_col]) else ""
-                status, score, reason = compare_company_domain(comp, dom)
-                statuses.append(status)
-                scores.append(score)
-                reasons.append(reason)
+            domains = _extract_domains_from_emails(df_master[email_col])
+            statuses, scores, reasons = compare_company_domain_series(df_master[company_col], domains)
 
             df_out["Domain_Check_Status"] = statuses
             df_out["Domain_Check_Score"] = scores
@@ -152,26 +289,8 @@ def run_matching(master_file, picklist_file, highlight_changes=True, progress=gr
 
         progress(0.9, desc="💾 Saving results...")
         out_file = f"{os.path.splitext(master_file.name)[0]} - Full_Check_Results.xlsx"
-        df_out.to_excel(out_file, index=False)
-
-        wb = load_workbook(out_file)
-        ws = wb.active
-        yellow = PatternFill(start_color="FFFF00", end_color="FFFF00", fill_type="solid")
-        green = PatternFill(start_color="C6EFCE", end_color="C6EFCE", fill_type="solid")
-        red = PatternFill(start_color="FFC7CE", end_color="FFC7CE", fill_type="solid")
-
-        for col_idx, col in enumerate(df_out.columns, start=1):
-            if "Domain_Check_Status" in col:
-                for row in range(2, ws.max_row + 1):
-                    val = str(ws.cell(row=row, column=col_idx).value).strip().lower()
-                    if "likely match" in val:
-                        ws.cell(row=row, column=col_idx).fill = green
-                    elif "not match" in val:
-                        ws.cell(row=row, column=col_idx).fill = red
-                    else:
-                        ws.cell(row=row, column=col_idx).fill = yellow
-
-        wb.save(out_file)
+        _write_results(df_out, out_file)
+
         progress(1.0, desc="✅ Done! File ready for download.")
         return out_file
 